@@ -1,16 +1,37 @@
 from phone_sensor import PhoneSensor
 from ansitable import ANSITable  # type: ignore
 import numpy as np  # type: ignore
-from typing import cast, Any
+from typing import cast, Any, List, Optional
+import sys
 
 phone = PhoneSensor(qrcode=True)
 
 print("Timing Performance Validation\n")
 
+# the clock is synced before the first command is answered, so wait for a client to connect
+phone.grab()
+if phone.clock.offset is None:
+    phone.close()
+    sys.exit("The client did not respond to clock sync pings, so latencies are unavailable. "
+             "Try reloading the app on your phone.")
+print(f"Clock offset: {phone.clock.offset} s, drift: {phone.clock.drift} s/s, "
+      f"round trip: {phone.clock.round_trip} s\n")
+
+
+def stats(host_timestamps: List[Optional[float]], latencies: List[Optional[float]]) -> List[Any]:
+    # the clock starts over if the phone reconnects, leaving some readings without host times
+    if None in host_timestamps or None in latencies:
+        return ["not synced"] * 7
+
+    times = cast(np.ndarray, np.diff(host_timestamps))  # type: ignore
+    return [times.mean(), np.median(times), times.min(), times.max(), times.std(),  # type: ignore
+            np.mean(latencies), np.max(latencies)]  # type: ignore
+
+
 n = 5
 print("PhoneSensor.grab(wait=?) n=" + str(n))
 grab_table = ANSITable("Expected (s)", "Resolution", "Encoding", "Quality", "Mean", "Median",
-                       "Min", "Max", "Std. Dev")
+                       "Min", "Max", "Std. Dev", "Latency Mean", "Latency Max")
 for wait_s in [0.1, 0.5, 1]:
     for resolution in [(320, 240), (640, 480), (1280, 960)]:
         for encoding in ["webp", "jpeg", "bmp"]:
@@ -20,28 +41,26 @@ for wait_s in [0.1, 0.5, 1]:
                         resolution=resolution,
                         encoding=cast(Any, encoding),
                         quality=quality,
-                        wait=wait_s)[1]
+                        wait=wait_s,
+                        timing=True)[1]
                     for _ in range(n + 1)
                 ]
 
-                # ask for 11 images and get the 'supposed' (according to client) difference in secs
-                times = cast(np.ndarray, np.diff(raw))  # type: ignore
-
-                grab_table.row(wait_s, resolution, encoding, quality, times.mean(),  # type: ignore
-                               np.median(times), times.min(), times.max(), times.std())  # type: ignore
+                # ask for 11 images and get the difference in capture times (according to host) in secs
+                grab_table.row(wait_s, resolution, encoding, quality,  # type: ignore
+                               *stats([t.host_timestamp for t in raw], [t.latency for t in raw]))
 
 grab_table.print()  # type: ignore
 
 n = 10
 print("PhoneSensor.imu(wait=?) n=" + str(n))
 imu_table = ANSITable("Expected (s)", "Mean", "Median",
-                      "Min", "Max", "Std. Dev")
+                      "Min", "Max", "Std. Dev", "Latency Mean", "Latency Max")
 for wait_s in [0.01, 0.1, 0.3, 0.5, 1]:
 
-    times = cast(np.ndarray, np.diff(  # type: ignore
-        [phone.imu(wait=wait_s).unix_timestamp for _ in range(n + 1)]))
-
-    imu_table.row(wait_s, times.mean(), np.median(times), times.min(), times.max(), times.std())  # type: ignore # nopep8
+    frames = [phone.imu(wait=wait_s) for _ in range(n + 1)]
+    imu_table.row(wait_s,  # type: ignore
+                  *stats([f.host_timestamp for f in frames], [f.latency for f in frames]))
 
 imu_table.print()  # type: ignore
 
@@ -3,9 +3,11 @@ from http import HTTPStatus
 from http.client import HTTPResponse
 from pathlib import Path
 from urllib.request import urlopen
-from typing import Any, ContextManager, Optional, Union, Tuple, cast
+from typing import Any, ContextManager, Deque, Optional, Union, Tuple, cast, overload
 from typing_extensions import Literal
+from collections import deque
 import json
+import time
 import socket
 from threading import Thread
 from queue import Queue
@@ -59,12 +61,111 @@ except ImportError:
             return np.flip(img, axis=2)  # type: ignore
 
 
+# number of clock sync pings to send as soon as a client connects
+_SYNC_BURST = 8
+# how long to wait for a client to answer a clock sync ping (s)
+_PING_TIMEOUT = 2.0
+# consecutive unanswered pings after which a client is assumed not to support clock sync
+_MAX_MISSED_PINGS = 3
+# minimum time spanned by the trusted ping exchanges before fitting a drift (s).
+# over shorter spans, jitter and the 1ms resolution of `Date.now()` swamp the slope
+_MIN_DRIFT_BASELINE = 20.0
+# crystal oscillators are typically within 100ppm. anything beyond this is noise
+_MAX_DRIFT = 1e-3
+
+
 class ImuDataFrame:
     unix_timestamp: float
     quaternion: Tuple[float, float, float, float]
     accelerometer: Optional[Tuple[float, float, float]]
     gyroscope: Optional[Tuple[float, float, float]]
     magnetometer: Optional[Tuple[float, float, float]]
+    host_timestamp: Optional[float]
+    latency: Optional[float]
+
+
+class CaptureTiming:
+    client_timestamp: float
+    host_timestamp: Optional[float]
+    received: float
+    latency: Optional[float]
+
+
+class ClockSync:
+    """NTP-style estimate of a client device's clock relative to the host's (`time.time()`).
+
+    Each ping exchange yields an offset sample (client - host) by assuming the client
+    stamped its reply halfway through the round trip. Slow exchanges are likely to be
+    asymmetric so only the fastest half are trusted. Once those span long enough,
+    a line is fit through them to track the drift between the two clocks.
+    """
+
+    def __init__(self, window: int = 64):
+        # (host time at round trip midpoint, offset, round trip time)
+        self._samples: Deque[Tuple[float, float, float]] = deque(maxlen=window)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add_sample(self, sent: float, client_timestamp: float, received: float):
+        """Record a ping exchange. All arguments are unix timestamps (seconds since epoch).
+
+        :param sent: Host time at which the ping was sent
+        :param client_timestamp: Client time at which the ping was answered
+        :param received: Host time at which the answer was received
+        """
+        midpoint = (sent + received) / 2
+        self._samples.append((midpoint, client_timestamp - midpoint, received - sent))
+
+    @property
+    def offset(self) -> Optional[float]:
+        """Current offset of the client clock ahead of the host clock (s), or None if not yet synced"""
+        return self.offset_at(time.time())
+
+    @property
+    def drift(self) -> Optional[float]:
+        """Rate at which the offset changes (s/s), or None if not yet synced"""
+        fit = self._fit()
+        return fit[2] if fit else None
+
+    @property
+    def round_trip(self) -> Optional[float]:
+        """Fastest observed ping round trip time (s), or None if not yet synced"""
+        # copy first as samples are appended from the server thread
+        samples = list(self._samples)
+        return min(rtt for _, _, rtt in samples) if samples else None
+
+    def offset_at(self, host_time: float) -> Optional[float]:
+        """Offset of the client clock ahead of the host clock at `host_time` (s), or None if not yet synced"""
+        fit = self._fit()
+        if fit is None:
+            return None
+        t_ref, offset, drift = fit
+        return offset + drift * (host_time - t_ref)
+
+    def to_host_time(self, client_timestamp: float) -> Optional[float]:
+        """Convert a client unix timestamp to the host clock, or None if not yet synced"""
+        # the offset barely changes over its own magnitude, so evaluating it
+        # at the client time rather than the (unknown) host time is fine
+        offset = self.offset_at(client_timestamp)
+        return None if offset is None else client_timestamp - offset
+
+    def _fit(self) -> Optional[Tuple[float, float, float]]:
+        samples = sorted(self._samples, key=lambda sample: sample[2])
+        if not samples:
+            return None
+
+        fastest = samples[:max(2, len(samples) // 2)]
+        host = np.array([t for t, _, _ in fastest])
+        offsets = np.array([offset for _, offset, _ in fastest])
+        # fit about the mean to keep the polynomial well conditioned
+        t_ref = float(host.mean())
+
+        if np.ptp(host) < _MIN_DRIFT_BASELINE:  # type: ignore
+            return t_ref, float(offsets.mean()), 0.0
+
+        drift, offset = np.polyfit(host - t_ref, offsets, 1)  # type: ignore
+        return t_ref, float(offset), float(np.clip(drift, -_MAX_DRIFT, _MAX_DRIFT))
 
 
 class ClientDisconnect(Exception):
@@ -85,7 +186,8 @@ class PhoneSensor(ContextManager['PhoneSensor']):
                  logger: logging.Logger = logging.getLogger(
                      'mvt.phone_sensor'),
                  log_level: int = logging.WARN,
-                 proxy_client_from: Optional[str] = None):
+                 proxy_client_from: Optional[str] = None,
+                 clock_sync_interval: Optional[float] = 1.0):
         """Initialize a `PhoneSensor` object
 
         :param qrcode: True to output a QRCode in the terminal window that points to the server accessible via LAN, defaults to False
@@ -96,13 +198,19 @@ class PhoneSensor(ContextManager['PhoneSensor']):
         :param proxy_client_from: A separate host from which to proxy the web client, defaults to None.
             Mainly for development purposes, using a hot-reloaded webpack server for the client
             rather than the one shipped with your `pip install`
+        :param clock_sync_interval: How often to ping the client to estimate its clock offset (seconds), defaults to 1.0.
+            Pings are sent even while commands arrive back-to-back, so a command may occasionally be
+            delayed by one ping round trip. None to disable clock syncing,
+            in which case host timestamps and latencies are unavailable.
         """
 
         self._ws: Optional[websockets.WebSocketServerProtocol] = None
-        self._out: Queue[Union[websockets.Data, ClientDisconnect]] = Queue()
+        self._out: Queue[Union[websockets.Data, Tuple[websockets.Data, float], ClientDisconnect]] = Queue()
         self._waiting = False
         self._qrcode = qrcode
         self._proxy_client_from = proxy_client_from
+        self._clock_sync_interval = clock_sync_interval
+        self.clock = ClockSync()
         self.logger = logger
         self.logger.setLevel(log_level)
         self.client_connected = False
@@ -119,6 +227,42 @@ class PhoneSensor(ContextManager['PhoneSensor']):
     def __exit__(self, _1, _2, _3):
         self.close()
 
+    @overload
+    def grab(self,
+             cam: Literal['front', 'back'] = ...,
+             *,
+             resolution: Tuple[int, int] = ...,
+             button: bool = ...,
+             wait: Optional[float] = ...,
+             encoding: Literal['jpeg', 'png', 'webp', 'bmp'] = ...,
+             quality: int = ...,
+             timing: Literal[False] = ...,
+             ) -> Tuple[np.ndarray, float]: ...
+
+    @overload
+    def grab(self,
+             cam: Literal['front', 'back'] = ...,
+             *,
+             resolution: Tuple[int, int] = ...,
+             button: bool = ...,
+             wait: Optional[float] = ...,
+             encoding: Literal['jpeg', 'png', 'webp', 'bmp'] = ...,
+             quality: int = ...,
+             timing: Literal[True],
+             ) -> Tuple[np.ndarray, CaptureTiming]: ...
+
+    @overload
+    def grab(self,
+             cam: Literal['front', 'back'] = ...,
+             *,
+             resolution: Tuple[int, int] = ...,
+             button: bool = ...,
+             wait: Optional[float] = ...,
+             encoding: Literal['jpeg', 'png', 'webp', 'bmp'] = ...,
+             quality: int = ...,
+             timing: bool = ...,
+             ) -> Tuple[np.ndarray, Union[float, CaptureTiming]]: ...
+
     def grab(self,
              cam: Literal['front', 'back'] = 'back',
              *,
@@ -127,7 +271,8 @@ class PhoneSensor(ContextManager['PhoneSensor']):
              wait: Optional[float] = None,
              encoding: Literal['jpeg', 'png', 'webp', 'bmp'] = 'webp',
              quality: int = 90,
-             ) -> Tuple[np.ndarray, float]:
+             timing: bool = False,
+             ) -> Tuple[np.ndarray, Union[float, CaptureTiming]]:
         """Grab an image from the first/currently connected webapp client
 
         :param cam: Default camera to use, defaults to 'back'.
@@ -149,17 +294,20 @@ class PhoneSensor(ContextManager['PhoneSensor']):
         :param quality: The quality (within (0, 100]) at which to encode the image, defaults to 90.
             Lower may slightly increase performance at the cost of image quality, however,
             the effect is typically insignificant. Does nothing for lossless encodings such as 'png'.
+        :param timing: True to return a `CaptureTiming` in place of the timestamp, defaults to False.
         :raises PhoneSensor.ClientDisconnect: If the device disconnects from the app after receiving the command.
         :return: An `(img, timestamp)` tuple,
             where `img` is a `numpy.ndarray` in the format you would expect from OpenCV (h x w x rgb)
-            and `timestamp` is a unix timestamp from the client device (seconds since epoch)
+            and `timestamp` is a unix timestamp from the client device (seconds since epoch).
+            If `timing=True`, `timestamp` is instead a `CaptureTiming` which also includes the capture time
+            according to the host clock and the capture-to-delivery latency (None until the clock is synced)
         """
 
         assert not (wait is not None and button), \
             "`wait` argument cannot be used with `button=True`"
         assert 0 <= quality <= 90
 
-        data = self._rpc(json.dumps({
+        data, received = self._rpc(json.dumps({
             'cmd': 'grab',
             'frontFacing': cam == 'front',
             'button': button,
@@ -185,6 +333,14 @@ class PhoneSensor(ContextManager['PhoneSensor']):
         #     dtype=np.uint8
         # ).reshape((height, width, 4))[:, :, :3]  # unsure whether this is faster/slower than delete. think so
 
+        if timing:
+            capture_timing = CaptureTiming()
+            capture_timing.client_timestamp = timestamp
+            capture_timing.received = received
+            capture_timing.host_timestamp = self.clock.to_host_time(timestamp)
+            capture_timing.latency = _latency(capture_timing.host_timestamp, received)
+            return img, capture_timing
+
         return img, timestamp
 
     def imu(self, wait: Optional[float] = None) -> ImuDataFrame:  # type: ignore
@@ -196,18 +352,22 @@ class PhoneSensor(ContextManager['PhoneSensor']):
             or if the browser disallows it, either due to app permissions or if it does not support the features.
         :return: An ImuDataFrame, with the orientation as a quaternion tuply and raw accelerometer, magnetometer and
             gyroscope tuples if supported by the browser (generally only new versions of Android Chrome).
-            Also includes the timestamp (seconds since epoch) at which the last quaternion reading was made.
+            Also includes the timestamp (seconds since epoch) at which the last quaternion reading was made,
+            that same time according to the host clock and the latency since (None until the clock is synced).
         """
-        resp = json.loads(self._rpc(json.dumps({
+        data, received = self._rpc(json.dumps({
             'cmd': 'imu',
             'wait': wait
-        })))
+        }))
+        resp = json.loads(data)
 
         if 'error' in resp:
             raise DataUnavailable(resp['error'])
 
         frame = ImuDataFrame()
         frame.unix_timestamp = resp['unixTimestamp']
+        frame.host_timestamp = self.clock.to_host_time(frame.unix_timestamp)
+        frame.latency = _latency(frame.host_timestamp, received)
         frame.quaternion = tuple(resp['quaternion'])
         for reading in ['accelerometer', 'gyroscope', 'magnetometer']:
             setattr(frame, reading, tuple(
@@ -290,12 +450,24 @@ class PhoneSensor(ContextManager['PhoneSensor']):
                     "Switched to new client before retrieving result from previous one."))
 
         self._ws = ws
+        # fresh estimate for each client, as they all have their own clocks
+        self.clock = ClockSync()
+        pinger = _ClockPinger(ws, self.clock, self._clock_sync_interval, self.logger)
 
         async def request_response():
-            cmd = await self._in.get()
+            if pinger.due(idle=self._in.empty()):
+                await pinger.ping()
+                return
+
+            try:
+                cmd = await asyncio.wait_for(self._in.get(), pinger.time_until_due())
+            except asyncio.TimeoutError:
+                await pinger.ping()
+                return
+
             await ws.send(cmd)
-            res = await ws.recv()
-            self._out.put(res)
+            res = await _recv_response(ws)
+            self._out.put((res, time.time()))
 
         try:
             while True:
@@ -308,9 +480,18 @@ class PhoneSensor(ContextManager['PhoneSensor']):
                     req_res.cancel()
                     break
 
+                # re-raise any disconnect, which would otherwise be lost in the task
+                req_res.result()
+
+                if self.stop_flag.done():
+                    break
+
         except WebSocketException as e:
-            self.client_connected = False
-            self._out.put(ClientDisconnect(f"Client from {ip} disconnected:"))
+            # a newer client may have already taken over
+            if self._ws is ws:
+                self.client_connected = False
+                if self._waiting:
+                    self._out.put(ClientDisconnect(f"Client from {ip} disconnected:"))
             raise e
 
     # for proxying the webpack websocket to the webpack dev server
@@ -396,6 +577,97 @@ class PhoneSensor(ContextManager['PhoneSensor']):
     ClientDisconnect = ClientDisconnect
     DataUnavailable = DataUnavailable
     ImuDataFrame = ImuDataFrame
+    CaptureTiming = CaptureTiming
+    ClockSync = ClockSync
+
+
+def _latency(host_timestamp: Optional[float], received: float) -> Optional[float]:
+    return None if host_timestamp is None else received - host_timestamp
+
+
+class _ClockPinger:
+    """Decides when to send clock sync pings to a client connection, and sends them"""
+
+    def __init__(self, ws: WebSocketServerProtocol, clock: ClockSync,
+                 interval: Optional[float], logger: logging.Logger):
+        self.ws = ws
+        self.clock = clock
+        self.interval = interval
+        self.logger = logger
+        self.enabled = interval is not None
+        self._last_ping = 0.0
+        self._missed = 0
+        self._ping_id = 0
+
+    def due(self, idle: bool) -> bool:
+        if not self.enabled:
+            return False
+
+        # sync before anything else so every reading can be converted to host time,
+        # then refine the estimate with a quick burst while idle
+        if len(self.clock) == 0 and self._missed == 0:
+            return True
+        if idle and len(self.clock) < _SYNC_BURST:
+            return True
+
+        # keep pinging even when commands are back-to-back, so the estimate keeps up with drift
+        return self.time_until_due() == 0
+
+    def time_until_due(self) -> Optional[float]:
+        if not self.enabled:
+            return None
+        return max(0.0, self._last_ping + cast(float, self.interval) - time.time())
+
+    async def ping(self):
+        self._last_ping = sent = time.time()
+        self._ping_id += 1
+        await self.ws.send(json.dumps({
+            'cmd': 'ping',
+            'id': self._ping_id
+        }))
+
+        try:
+            pong = await asyncio.wait_for(self._recv_pong(self._ping_id), _PING_TIMEOUT)
+        except asyncio.TimeoutError:
+            # count the interval from now, otherwise the next ping would be due before any queued command
+            self._last_ping = time.time()
+            self._missed += 1
+            if self._missed >= _MAX_MISSED_PINGS:
+                # probably an outdated client that doesn't know how to pong
+                self.enabled = False
+                self.logger.warning(
+                    "Client did not respond to clock sync pings. Host timestamps and latencies will be unavailable")
+            else:
+                self.logger.info("Client did not respond to clock sync ping in time")
+            return
+
+        self._missed = 0
+        self.clock.add_sample(sent, pong['pong'] / 1000.0, time.time())
+
+    async def _recv_pong(self, ping_id: int) -> Any:
+        while True:
+            pong = _parse_pong(await self.ws.recv())
+            # skip late answers to pings that previously timed out
+            if pong is not None and pong.get('id') == ping_id:
+                return pong
+
+
+async def _recv_response(ws: WebSocketServerProtocol) -> websockets.Data:
+    res = await ws.recv()
+    # discard late answers to pings that previously timed out
+    while _parse_pong(res) is not None:
+        res = await ws.recv()
+    return res
+
+
+def _parse_pong(msg: websockets.Data) -> Optional[Any]:
+    if not isinstance(msg, str):
+        return None
+    try:
+        pong = json.loads(msg)
+    except ValueError:
+        return None
+    return pong if isinstance(pong, dict) and 'pong' in pong else None
 
 
 # Adapted from https://docs.python.org/3/library/ssl.html#self-signed-certificates
@@ -1,7 +1,14 @@
 from http import HTTPStatus
 from phone_sensor import PhoneSensor
+from phone_sensor.phone_sensor import _ClockPinger, _recv_response, WebSocketException
 import unittest
+from unittest.mock import patch
 from urllib.request import urlopen
+import asyncio
+import json
+import logging
+import math
+import random
 import ssl
 
 
@@ -10,6 +17,15 @@ class TestPhoneSensor(unittest.TestCase):
     def test_constructor(self):
         PhoneSensor().close()
 
+    def test_handler_exits_on_disconnect(self):
+        with PhoneSensor() as phone:
+            handler = asyncio.run_coroutine_threadsafe(
+                phone._api(ClosedWebSocket(), '/ws'), phone.loop)
+
+            with self.assertRaises(WebSocketException):
+                handler.result(timeout=5)
+            assert not phone.client_connected
+
     def test_server_shutsdown(self):
         with PhoneSensor():
             pass
@@ -31,6 +47,176 @@ class TestPhoneSensor(unittest.TestCase):
                     as client_html:
                 assert client_html.status == HTTPStatus.OK
 
+
+class TestClockSync(unittest.TestCase):
+
+    def test_unsynced(self):
+        clock = PhoneSensor.ClockSync()
+        assert clock.offset is None
+        assert clock.drift is None
+        assert clock.to_host_time(1000.0) is None
+
+    def test_single_sample(self):
+        clock = PhoneSensor.ClockSync()
+        # client is 5s ahead, answering halfway through a 1s round trip
+        clock.add_sample(100.0, 105.5, 101.0)
+        assert clock.offset_at(100.5) == 5.0
+        assert clock.to_host_time(110.0) == 105.0
+        assert clock.round_trip == 1.0
+
+    def test_ignores_slow_exchanges(self):
+        clock = PhoneSensor.ClockSync()
+        for i in range(10):
+            sent = 100.0 + i
+            clock.add_sample(sent, sent + 2.01, sent + 0.02)
+        # a congested exchange where the request was held up on the way
+        clock.add_sample(110.0, 110.0 + 2.9, 111.0)
+        offset = clock.offset_at(105.0)
+        assert offset is not None and abs(offset - 2.0) < 1e-6
+
+    def test_drift(self):
+        clock = PhoneSensor.ClockSync()
+        drift = 1e-4
+        for i in range(60):
+            sent = 100.0 + i
+            clock.add_sample(sent, sent + 0.01 + 2.0 + drift * i, sent + 0.02)
+        estimate = clock.drift
+        assert estimate is not None and abs(estimate - drift) < 1e-9
+
+    def test_drift_clamped(self):
+        clock = PhoneSensor.ClockSync()
+        for i in range(60):
+            sent = 100.0 + i
+            clock.add_sample(sent, sent + 0.01 + 0.1 * i, sent + 0.02)
+        assert clock.drift == 1e-3
+
+    def test_short_burst(self):
+        rand = random.Random(0)
+        true_offset = 3.0
+        for _ in range(50):
+            clock = PhoneSensor.ClockSync()
+            sent = 100.0
+            # a burst of jittery LAN pings, stamped with `Date.now()`'s 1ms resolution
+            for _ in range(8):
+                up, down = rand.uniform(0.002, 0.012), rand.uniform(0.002, 0.012)
+                client = math.floor((sent + up + true_offset) * 1000) / 1000
+                clock.add_sample(sent, client, sent + up + down)
+                sent += up + down
+
+            assert clock.drift == 0.0
+            host_time = clock.to_host_time(sent + 60 + true_offset)
+            assert host_time is not None and abs(host_time - (sent + 60)) < 0.015
+
+
+class FakeWebSocket:
+    """Replies with each of `replies` in turn, then never again"""
+
+    def __init__(self, *replies):
+        self.sent = []
+        self.replies = list(replies)
+
+    async def send(self, msg):
+        self.sent.append(json.loads(msg))
+
+    async def recv(self):
+        if not self.replies:
+            await asyncio.sleep(3600)
+        reply = self.replies.pop(0)
+        # build pongs from the latest ping
+        return reply(self.sent[-1]) if callable(reply) else reply
+
+
+class ClosedWebSocket:
+    local_address = ('127.0.0.1', 8000)
+
+    async def send(self, msg):
+        raise WebSocketException("closed")
+
+    async def recv(self):
+        raise WebSocketException("closed")
+
+
+def pong(ping):
+    return json.dumps({'pong': 1000, 'id': ping['id']})
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@patch('phone_sensor.phone_sensor._PING_TIMEOUT', 0.01)
+class TestClockPinger(unittest.TestCase):
+
+    def pinger(self, ws, interval=1.0):
+        return _ClockPinger(ws, PhoneSensor.ClockSync(), interval, logging.getLogger('test'))
+
+    def test_pings_first(self):
+        pinger = self.pinger(FakeWebSocket(pong))
+        assert pinger.due(idle=False)
+        run(pinger.ping())
+        assert len(pinger.clock) == 1
+        assert pinger.clock.to_host_time(1.0) is not None
+
+    def test_pings_under_load(self):
+        pinger = self.pinger(FakeWebSocket(*[pong] * 8), interval=0.05)
+        for _ in range(8):
+            run(pinger.ping())
+        assert not pinger.due(idle=False)
+        run(asyncio.sleep(0.05))
+        assert pinger.due(idle=False)
+
+    def test_tolerates_late_pong(self):
+        ws = FakeWebSocket()
+        pinger = self.pinger(ws)
+        run(pinger.ping())
+        assert pinger.enabled and len(pinger.clock) == 0
+
+        # the answer to the first ping arrives late
+        ws.replies = [json.dumps({'pong': 0, 'id': 1}), pong]
+        run(pinger.ping())
+        assert pinger.enabled and len(pinger.clock) == 1
+        assert ws.replies == []
+
+    def test_missed_ping_does_not_delay_commands(self):
+        pinger = self.pinger(FakeWebSocket())
+        run(pinger.ping())
+        assert pinger.enabled
+        assert not pinger.due(idle=False)
+
+    def test_skips_unexpected_messages(self):
+        ws = FakeWebSocket(b'binary', 'not json', '[1]', pong)
+        pinger = self.pinger(ws)
+        run(pinger.ping())
+        assert len(pinger.clock) == 1
+
+    def test_disables_after_missed_pings(self):
+        pinger = self.pinger(FakeWebSocket())
+        run(pinger.ping())
+        run(pinger.ping())
+        assert pinger.enabled
+        run(pinger.ping())
+        assert not pinger.enabled
+        assert not pinger.due(idle=True)
+        assert pinger.time_until_due() is None
+
+    def test_disabled(self):
+        pinger = self.pinger(FakeWebSocket(), interval=None)
+        assert not pinger.due(idle=True)
+        assert pinger.time_until_due() is None
+
+    def test_recv_response_discards_stale_pongs(self):
+        ws = FakeWebSocket(json.dumps({'id': 1, 'pong': 0}), b'image')
+        assert run(_recv_response(ws)) == b'image'
+
+    def test_recv_response_keeps_other_messages(self):
+        imu = json.dumps({'unixTimestamp': 0, 'quaternion': [0, 0, 0, 1]})
+        assert run(_recv_response(FakeWebSocket(imu))) == imu
+
+
 # testing client-functionality will require https://github.com/pyppeteer/pyppeteer
 
 
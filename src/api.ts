@@ -16,11 +16,20 @@ type ImuApiMsg = {
   wait: number | null;
 };
 
+type PingApiMsg = {
+  cmd: "ping"; // clock sync - reply with our timestamp asap
+  id: number;
+};
+
 type ServerDisconnectMsg = {
   cmd: "disconnect"; // occurs when a second client attempts to connect - switches to newest
 };
 
-type ApiMsg = CameraGrabApiMsg | ImuApiMsg | ServerDisconnectMsg;
+type ApiMsg =
+  | CameraGrabApiMsg
+  | ImuApiMsg
+  | PingApiMsg
+  | ServerDisconnectMsg;
 
 type ImuDataFrame = {
   unixTimestamp: number;
@@ -95,6 +104,12 @@ export class Api {
   }
 
   private async onMsg(msg: ApiMsg) {
+    // answer before anything else, as any delay skews the server's clock offset estimate
+    if (msg.cmd === "ping") {
+      this.send({ pong: Date.now(), id: msg.id });
+      return;
+    }
+
     // handle "wait"
     if ("wait" in msg && msg["wait"] !== null) {
       const nowMs = Date.now();